@@ -1,2 +1,5 @@
-from murdock_ci import murdock
-from .murdock import main
+def main():
+    # imported lazily, loading murdock_ci.murdock requires the server
+    # configuration, which murdock_ci.agent does not use.
+    from .murdock import main
+    main()
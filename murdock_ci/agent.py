@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+
+import functools
+import os
+import sys
+import json
+import signal
+import socket
+import threading
+import traceback
+import urllib.error
+import urllib.request
+
+from threading import Event, Lock
+
+from .log import log
+from .config import Config
+from .limits import BuildLimits, enable_controllers
+from .supervisor import BuildDir, Supervisor
+
+
+class AgentConfig(Config):
+    def set_defaults(s):
+        super().set_defaults()
+        s.set_default("name", socket.gethostname())
+        s.set_default("agents", 1)
+        s.set_default("cpus", max(1, (os.cpu_count() or 1) // s.config["agents"]))
+        s.set_default("memory", 0)
+        s.set_default("cgroup_dir", None)
+        s.set_default("scripts_dir", os.getcwd() + "/scripts")
+        s.set_default("work_dir", os.getcwd() + "/work")
+        s.set_default("poll_interval", 10)
+        s.set_default("heartbeat_interval", 5)
+        s.set_default("sigterm_timeout", 100)
+        s.set_default("server_url", None)
+        s.set_default("agent_token", None)
+
+
+class OutputBuffer(object):
+    """ Collects build output until it gets uploaded. """
+    def __init__(s):
+        s.lock = Lock()
+        s.data = bytearray()
+
+    def write(s, data):
+        with s.lock:
+            s.data.extend(data)
+
+    def take(s):
+        with s.lock:
+            data = bytes(s.data)
+            s.data.clear()
+            return data
+
+    def restore(s, data):
+        with s.lock:
+            s.data[0:0] = data
+
+
+class Agent(threading.Thread):
+    """ Remote build agent.
+
+    Leases jobs from a Murdock server, runs "build.sh build" locally and
+    streams the output back. Every output upload doubles as heartbeat.
+    Once stopping is set, a running build is killed and its job given back
+    to the server.
+    """
+    def __init__(s, config, supervisor, stopping, num):
+        threading.Thread.__init__(s, daemon=True)
+        s.config = config
+        s.supervisor = supervisor
+        s.stopping = stopping
+        s.agent_name = "%s-%s" % (config.name, num)
+        s.work_dir = os.path.join(config.work_dir, str(num))
+        s.start()
+
+    def request(s, action, body=b"", lease=None):
+        url = "%s/api/agent/%s" % (s.config.server_url.rstrip("/"), action)
+        if lease:
+            url += "?lease=%s" % lease
+
+        req = urllib.request.Request(url, data=body, method="POST",
+                headers={ "Authorization" : "token %s" % s.config.agent_token })
+        try:
+            with urllib.request.urlopen(req, timeout=30) as res:
+                data = res.read()
+                return res.status, json.loads(data.decode("utf-8")) if data else None
+        except urllib.error.HTTPError as e:
+            return e.code, None
+        except OSError as e:
+            log.warning("Agent %s: %s request failed: %s", s.agent_name, action, e)
+            return None, None
+
+    def run(s):
+        log.info("Agent %s: started.", s.agent_name)
+        while not s.stopping.is_set():
+            try:
+                body = json.dumps({
+                    "agent" : s.agent_name,
+                    "cpus" : s.config.cpus,
+                    "memory" : s.config.memory,
+                    }).encode("utf-8")
+                code, job = s.request("lease", body)
+                if code == 200:
+                    s.build(job)
+                else:
+                    if code not in { 204, None }:
+                        log.warning("Agent %s: lease request failed with code %s", s.agent_name, code)
+                    s.stopping.wait(s.config.poll_interval)
+            except Exception as e:
+                log.warning("Agent %s: uncaught exception: %s", s.agent_name, e)
+                traceback.print_exc()
+                s.stopping.wait(s.config.poll_interval)
+
+    def build(s, job):
+        log.info("Agent %s: building job %s", s.agent_name, job["name"])
+
+        try:
+            build_dir = BuildDir.acquire(os.path.join(s.work_dir, "job"))
+        except OSError as e:
+            s.report_error(job, "cannot create build directory: %s" % e)
+            return
+
+        try:
+            s.run_build(job, build_dir)
+        finally:
+            build_dir.release()
+
+    def run_build(s, job, build_dir):
+        lease = job["lease"]
+
+        _env = os.environ.copy()
+        _env.update(job["env"])
+        _env["CI_SCRIPTS_DIR"] = s.config.scripts_dir
+
+        limits = BuildLimits("murdock-agent-%s-%s" % (s.agent_name, lease[:8]),
+                             job["cpus"], job["memory"], s.config.cgroup_dir)
+
+        on_exit = functools.partial(s.build_exited, limits, build_dir)
+
+        output = OutputBuffer()
+        try:
+            build = s.supervisor.spawn([ os.path.join(s.config.scripts_dir, "build.sh"), "build" ],
+                         output, on_exit=on_exit,
+                         timeout=job["timeout"], output_timeout=job["output_timeout"],
+                         cwd=build_dir.path, env=_env, preexec_fn=limits.preexec_fn())
+        except Exception as e:
+            on_exit()
+            s.report_error(job, "cannot start build.sh: %s" % e)
+            return
+
+        canceled = False
+        while True:
+            done = build.wait(s.config.heartbeat_interval)
+
+            if s.stopping.is_set():
+                log.info("Agent %s: shutting down, giving back job %s", s.agent_name, job["name"])
+                build.kill()
+                s.request("release", b"", lease)
+                return
+
+            chunk = output.take()
+            code, reply = s.request("output", chunk, lease)
+            if code == 200:
+                if reply["cancel"] and not canceled:
+                    log.info("Agent %s: job %s canceled", s.agent_name, job["name"])
+                    canceled = True
+                    build.kill()
+            elif code is None:
+                # server unreachable, keep the output for the next try
+                output.restore(chunk)
+                if done:
+                    # the tail of the log is the interesting part, don't
+                    # post the result before it got uploaded
+                    s.stopping.wait(s.config.poll_interval)
+                    continue
+            else:
+                log.warning("Agent %s: lost lease for job %s (code %s)", s.agent_name, job["name"], code)
+                build.kill()
+                return
+
+            if done:
+                break
+
+        if canceled:
+            result = "canceled"
+        elif build.timed_out:
+            result = "timeout"
+        elif build.returncode == 0:
+            result = "passed"
+        else:
+            result = "errored"
+
+        log.info("Agent %s: job %s finished. result: %s", s.agent_name, job["name"], result)
+        s.post_result(job, result)
+
+    def post_result(s, job, result):
+        body = json.dumps({ "result" : result }).encode("utf-8")
+        while s.request("result", body, job["lease"])[0] is None:
+            if s.stopping.wait(s.config.poll_interval):
+                break
+
+    def report_error(s, job, message):
+        """ report a build that could not be run as errored, so its job
+        doesn't go from one broken agent to the next """
+        log.warning("Agent %s: job %s: %s", s.agent_name, job["name"], message)
+        output = "murdock-agent %s: %s\n" % (s.agent_name, message)
+        s.request("output", output.encode("utf-8"), job["lease"])
+        s.post_result(job, "errored")
+
+    def build_exited(s, limits, build_dir):
+        """ called by the supervisor once the build's process group is gone """
+        limits.release()
+        build_dir.release()
+
+def main():
+    if len(sys.argv) > 1:
+        config_file = sys.argv[1]
+    else:
+        config_file = "/etc/murdock-agent.toml"
+
+    config = AgentConfig(config_file)
+    if not (config.server_url and config.agent_token):
+        raise SystemExit("No server_url or agent_token provided in the "
+                         "configuration file.")
+
+    if config.cgroup_dir:
+        try:
+            enable_controllers(config.cgroup_dir)
+        except OSError as e:
+            raise SystemExit("Cannot use cgroup_dir %s: %s" % (config.cgroup_dir, e))
+
+    stopping = Event()
+    signal.signal(signal.SIGTERM, lambda sig, frame: stopping.set())
+
+    supervisor = Supervisor(config.sigterm_timeout)
+    agents = [ Agent(config, supervisor, stopping, num) for num in range(config.agents) ]
+    log.info("murdock agent initialized (%s agents).", len(agents))
+
+    try:
+        while not stopping.wait(1):
+            pass
+    except KeyboardInterrupt:
+        stopping.set()
+
+    log.info("murdock agent shutting down...")
+    for agent in agents:
+        agent.join()
+    supervisor.drain()
+
+    log.info("murdock agent shut down.")
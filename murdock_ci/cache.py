@@ -0,0 +1,70 @@
+import hashlib
+import json
+import os
+
+from collections import OrderedDict
+from threading import Lock
+
+from .log import log
+
+
+def dir_digest(path):
+    """ SHA1 over the names and contents of all files below path """
+    digest = hashlib.sha1()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            filename = os.path.join(root, name)
+            digest.update(os.path.relpath(filename, path).encode("utf-8") + b"\0")
+            try:
+                with open(filename, "rb") as f:
+                    digest.update(f.read())
+            except OSError:
+                pass
+    return digest.hexdigest()
+
+
+class ResultCache(object):
+    """ Persistent map of build keys (e.g., merge tree SHAs) to build results.
+
+    Entries are kept in insertion order, the oldest ones are dropped once
+    more than size entries are stored. The cache is written to filename
+    after every change.
+    """
+    def __init__(s, filename, size):
+        s.lock = Lock()
+        s.filename = filename
+        s.size = size
+        s.entries = OrderedDict()
+        s.load()
+
+    def load(s):
+        try:
+            with open(s.filename, "r") as f:
+                s.entries = OrderedDict(json.load(f))
+            log.info("ResultCache: loaded %s entries from %s", len(s.entries), s.filename)
+        except FileNotFoundError:
+            pass
+        except ValueError as e:
+            log.warning("ResultCache: ignoring corrupt cache file %s: %s", s.filename, e)
+
+    def save(s):
+        tmpfile = s.filename + ".tmp"
+        with open(tmpfile, "w") as f:
+            json.dump(list(s.entries.items()), f)
+        os.replace(tmpfile, s.filename)
+
+    def get(s, key):
+        with s.lock:
+            return s.entries.get(key)
+
+    def put(s, key, **entry):
+        with s.lock:
+            s.entries.pop(key, None)
+            s.entries[key] = entry
+            while len(s.entries) > s.size:
+                s.entries.popitem(last=False)
+            try:
+                s.save()
+            except OSError as e:
+                log.warning("ResultCache: cannot write %s: %s", s.filename, e)
@@ -2,6 +2,7 @@ import tornado.httpserver
 import tornado.ioloop
 import tornado.web
 import tornado.websocket
+import hmac
 import json
 import os
 import asyncio
@@ -9,22 +10,27 @@ import asyncio
 from threading import Lock
 
 from .log import log
+from .jobs import JobResult
 from .util import config
 
 config.set_default("url_prefix", r"")
 
 class GithubWebhook(object):
-    def __init__(s, port, prs, github_handlers):
+    def __init__(s, port, prs, github_handlers, agents=None):
 
         s.secret = "__secret"
         s.port = port
-        s.application = tornado.web.Application([
+        handlers = [
 #            (r"/", GithubWebhook.MainHandler),
             (config.url_prefix + r"/api/pull_requests", GithubWebhook.PullRequestHandler, dict(prs=prs)),
             (config.url_prefix + r"/github", GithubWebhook.GithubWebhookHandler, dict(handler=github_handlers)),
             (config.url_prefix + r"/status", GithubWebhook.StatusWebSocket),
             (config.url_prefix + r"/control", GithubWebhook.ControlHandler),
-                ])
+                ]
+        if agents:
+            handlers.append((config.url_prefix + r"/api/agent/(lease|output|result|release)", GithubWebhook.AgentHandler, dict(agents=agents)))
+
+        s.application = tornado.web.Application(handlers)
         s.server = tornado.httpserver.HTTPServer(s.application)
         s.server.listen(s.port)
         s.websocket_lock = Lock()
@@ -70,8 +76,9 @@ class GithubWebhook(object):
             if building:
                 _building = []
                 for pr, job in building:
+                    extras = { "remaining" : job.remaining() }
                     _building.append(
-                            gen_pull_entry(pr, job, job.time_started))
+                            gen_pull_entry(pr, job, job.time_started, extras))
                 response['building'] = _building
 
             if queued:
@@ -178,3 +185,43 @@ class GithubWebhook(object):
 #            data = json.loads(self.request.body)
             s = GithubWebhook.StatusWebSocket
             s.write_message_all(self.request.body)
+
+    class AgentHandler(tornado.web.RequestHandler):
+        def initialize(s, agents):
+            s.agents = agents
+
+        def prepare(s):
+            auth = s.request.headers.get("Authorization", "")
+            if not hmac.compare_digest(auth, "token %s" % config.agent_token):
+                raise tornado.web.HTTPError(403)
+
+        def post(s, action):
+            s.set_header("Content-Type", 'application/json; charset="utf-8"')
+
+            if action == "lease":
+                data = json.loads(s.request.body.decode("utf-8"))
+                lease = s.agents.lease(data.get("agent", s.request.remote_ip),
+                                       data.get("cpus", 1), data.get("memory", 0))
+                if lease:
+                    s.write(json.dumps(lease.describe()))
+                else:
+                    s.set_status(204)
+                return
+
+            lease = s.agents.get(s.get_argument("lease"))
+            if not lease:
+                raise tornado.web.HTTPError(404)
+
+            if action == "output":
+                s.agents.output(lease, s.request.body)
+            elif action == "result":
+                data = json.loads(s.request.body.decode("utf-8"))
+                try:
+                    result = JobResult[data["result"]]
+                except KeyError:
+                    raise tornado.web.HTTPError(400)
+                s.agents.finish(lease, result)
+            elif action == "release":
+                s.agents.release(lease)
+
+            s.write(json.dumps({ "cancel" : lease.canceled }))
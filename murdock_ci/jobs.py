@@ -19,20 +19,44 @@ class JobResult(Enum):
     unknown = 4
 
 class Job(object):
-    id = 0
-    def __init__(s, name, cmd, env=None, hook=None, arg=None):
+    __slots__ = ( "lock", "id", "name", "cmd", "action", "priority", "env", "worker", "cpus",
+                  "memory", "timeout", "output_timeout", "hook", "arg",
+                  "build_digest", "state", "result", "time_created",
+                  "time_queued", "time_started", "time_finished" )
+
+    next_id = 0
+
+    def __init__(s, name, cmd, env=None, hook=None, arg=None, cpus=1, memory=0,
+                 timeout=0, output_timeout=0, action="build", priority=0):
         s.lock = Lock()
-        s.id = Job.id
-        Job.id += 1
+        s.id = Job.next_id
+        Job.next_id += 1
 
         s.name = name
         s.cmd = cmd
+        # first argument to cmd
+        s.action = action
+        # jobs of higher priority are handed out first
+        s.priority = priority
         s.env = env
         s.worker = None
 
+        # resource weight: cores and MiB (0: not accounted)
+        s.cpus = cpus
+        s.memory = memory
+
+        # seconds of total runtime / without output before the build gets
+        # killed (0: unlimited)
+        s.timeout = timeout
+        s.output_timeout = output_timeout
+
         s.hook = hook
         s.arg = arg
 
+        # digest of everything besides the sources the build depends on,
+        # None if its result shouldn't be cached
+        s.build_digest = None
+
         s.result = JobResult.unknown
 
         s.time_created = -1
@@ -63,6 +87,20 @@ class Job(object):
         if s.hook:
             s.hook(s.arg, s)
 
+    def remaining(s):
+        """ seconds left until a running job times out, None if unlimited """
+        if s.state != JobState.running or not s.worker:
+            return None
+
+        now = time.time()
+        left = []
+        if s.timeout:
+            left.append(s.time_started + s.timeout - now)
+        if s.output_timeout:
+            left.append(s.worker.time_output() + s.output_timeout - now)
+
+        return max(0, min(left)) if left else None
+
     def stopped(s, result):
         with s.lock:
             s.state = result
@@ -0,0 +1,77 @@
+import os
+import resource
+
+from .log import log
+
+
+def enable_controllers(cgroup_root):
+    """ Enable the cpu and memory controllers for the children of
+    cgroup_root. Raises OSError if that is not possible. """
+    if not os.path.isfile(os.path.join(cgroup_root, "cgroup.procs")):
+        raise OSError("%s is not a cgroup" % cgroup_root)
+    with open(os.path.join(cgroup_root, "cgroup.subtree_control"), "w") as f:
+        f.write("+cpu +memory")
+
+
+class BuildLimits(object):
+    """ Enforces the resource share of a build.
+
+    If cgroup_root points to a writable (delegated) cgroup v2 directory (see
+    enable_controllers()), each build gets its own child cgroup with cpu.max
+    and memory.max set.
+    Otherwise, the memory share is applied as RLIMIT_AS to the build
+    processes and the CPU share is only advisory (CI_JOBS).
+    """
+    def __init__(s, name, cpus, memory, cgroup_root=None):
+        s.cpus = cpus
+        s.memory = memory
+        s.cgroup = None
+
+        if cgroup_root:
+            path = os.path.join(cgroup_root, name)
+            try:
+                if not os.path.isdir(path):
+                    os.mkdir(path)
+                # a new directory within cgroupfs gets populated by the kernel
+                if not os.path.isfile(os.path.join(path, "cgroup.procs")):
+                    raise OSError("%s is not a cgroup" % cgroup_root)
+                s._write(path, "cpu.max", "%d 100000" % (cpus * 100000))
+                if memory:
+                    s._write(path, "memory.max", str(memory * 1024 * 1024))
+                s.cgroup = path
+            except OSError as e:
+                log.warning("BuildLimits: cannot set up cgroup %s (%s), using rlimits", path, e)
+                s.remove_cgroup(path)
+
+    def _write(s, path, filename, value):
+        with open(os.path.join(path, filename), "w") as f:
+            f.write(value)
+
+    def preexec_fn(s):
+        """ preexec_fn to pass to Popen, None if there is nothing to apply.
+
+        preexec_fn is not safe to use in threaded programs, so it is only
+        used if it is really needed.
+        """
+        if s.cgroup or s.memory:
+            return s.preexec
+        return None
+
+    def preexec(s):
+        """ runs in the forked build process """
+        if s.cgroup:
+            s._write(s.cgroup, "cgroup.procs", str(os.getpid()))
+        elif s.memory:
+            limit = s.memory * 1024 * 1024
+            resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+    def remove_cgroup(s, path):
+        try:
+            os.rmdir(path)
+        except OSError as e:
+            log.debug("BuildLimits: cannot remove cgroup %s: %s", path, e)
+
+    def release(s):
+        if s.cgroup:
+            s.remove_cgroup(s.cgroup)
+            s.cgroup = None
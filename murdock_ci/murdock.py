@@ -2,21 +2,28 @@
 
 import os
 import subprocess
+import functools
+import hashlib
 import json
 import signal
-import shutil
+import time
 import tornado.ioloop
 import traceback
 
 import threading
-from queue import Queue, Empty
 from threading import Lock
 
 from agithub.GitHub import GitHub
 
 from .log import log
+from .cache import ResultCache, dir_digest
 from .jobs import Job, JobResult, JobState
 from .github_webhook import GithubWebhook
+from .limits import BuildLimits, enable_controllers
+from .remote import RemoteWorkerPool
+from .scheduler import JobQueue, Resources
+from .supervisor import BuildDir, Supervisor
+from .warmcache import WarmCache
 from .util import config
 
 
@@ -42,14 +49,24 @@ def nicetime(time):
     res += "%ss" % secs
     return res
 
+@functools.lru_cache(maxsize=1024)
+def merge_tree(repo, commit):
+    """ tree SHA of a (merge) commit, commits don't change """
+    code, result = github.repos[repo].git.commits[commit].get()
+    if code != 200:
+        raise LookupError("code %s" % code)
+    return result["tree"]["sha"]
+
 class ShellWorker(threading.Thread):
     _lock = Lock()
     num_workers = 0
 
-    def __init__(self, queue):
+    def __init__(self, queue, resources, supervisor):
         threading.Thread.__init__(self, daemon=True)
-        self.process = None
+        self.build = None
         self.queue = queue
+        self.resources = resources
+        self.supervisor = supervisor
         self.canceled = False
         self.job = None
         with ShellWorker._lock:
@@ -61,107 +78,129 @@ class ShellWorker(threading.Thread):
         log.info("ShellWorker %s: started.", s.num)
         while True:
             try:
-                try:
-                    s.job = None
-                    s.process = None
-                    s.canceled = False
-                    job = s.queue.get()
-                    s.job = job
-                except Empty:
+                s.job = None
+                s.build = None
+                s.canceled = False
+                job = s.queue.get(s.resources.try_acquire)
+                if not job:
+                    log.info("ShellWorker %s: stopped.", s.num)
                     return
-                if job.state == JobState.finished:
-                    log.info("ShellWorker %s: skipping finished job %s", s.num, job.name)
-                    s.queue.task_done()
-                    continue
-                else:
-                    log.info("ShellWorker %s: building job %s", s.num, job.name)
-
                 s.job = job
+
+                cpus, memory = s.resources.allocation(job)
+                log.info("ShellWorker %s: building job %s (cpus: %s, memory: %s)", s.num, job.name, cpus, memory)
+
                 job.worker = s
                 s.job.set_state(JobState.running)
                 s.job.env["CI_BUILD_ID"] = str(s.job.time_started)
+                s.job.env["CI_JOBS"] = str(cpus)
 
-                build_dir = os.path.join(s.job.data_dir(), "build")
-                try:
-                    os.makedirs(build_dir)
-                except FileExistsError:
-                    shutil.rmtree(build_dir)
-                    os.makedirs(build_dir)
-
-                _env = os.environ.copy()
-                _env.update(s.job.env)
-
-                output_file = open(os.path.join(s.job.data_dir(), "output.txt"), mode='wb')
-                s.process = p = subprocess.Popen([ s.job.cmd, "build" ],
-                             stdout=subprocess.PIPE,
-                             stderr=subprocess.STDOUT,
-                             cwd=s.job.data_dir(), env=_env, start_new_session=True)
-                s.job.worker = s
+                data_dir = s.job.data_dir()
+                build_dir = BuildDir.acquire(os.path.join(data_dir, "build"))
                 try:
-                    for line in p.stdout:
-                        output_file.write(line)
-                except Exception as e:
-                    log.info(e)
+                    s.run_build(data_dir, build_dir, cpus, memory)
                 finally:
-                    output_file.close()
-
-                log.info("ShellWorker %s: Job %s finished. result: %s", s.num, s.job.name, s.job.result)
+                    build_dir.release()
 
-                if s.process:
-                    s.process.wait()
+            except Exception as e:
+               log.warning("ShellWorker %s: uncaught exception: %s", s.num, e)
+               traceback.print_exc()
+               if s.job:
+                   s.resources.release(s.job)
+                   s.queue.wakeup()
 
-                try:
-                    subprocess.check_call([s.job.cmd, "post_build"], cwd=s.job.data_dir(), env=_env)
-                except subprocess.CalledProcessError:
-                    log.warning("Job %s: post build script failed.", s.job.name)
-                    pass
+    def run_build(s, data_dir, build_dir, cpus, memory):
+        _env = os.environ.copy()
+        _env.update(s.job.env)
 
-                if s.canceled:
-                    s.job.set_state(JobState.finished, JobResult.canceled)
-                else:
-                    ret = s.process.returncode
-                    s.process = None
-                    if ret == 0:
-                        s.job.set_state(JobState.finished, JobResult.passed)
-                    else:
-                        s.job.set_state(JobState.finished, JobResult.errored)
+        limits = BuildLimits("murdock-%s" % s.job.id, cpus, memory, config.cgroup_dir)
+        on_exit = functools.partial(s.build_exited, limits, build_dir)
 
-                try:
-                    shutil.rmtree(build_dir)
-                except FileNotFoundError:
-                    pass
+        output_file = open(os.path.join(data_dir, "output.txt"), mode='wb')
+        try:
+            s.build = s.supervisor.spawn([ s.job.cmd, s.job.action ], output_file,
+                         on_exit=on_exit,
+                         timeout=s.job.timeout,
+                         output_timeout=s.job.output_timeout,
+                         cwd=data_dir, env=_env,
+                         preexec_fn=limits.preexec_fn())
+        except Exception:
+            output_file.close()
+            on_exit()
+            raise
 
-                s.queue.task_done()
+        try:
+            if s.canceled:
+                s.build.kill()
+            s.build.wait()
+        finally:
+            output_file.close()
 
-            except Exception as e:
-               log.warning("ShellWorker %s: uncaught exception: %s", s.num, e)
-               traceback.print_exc()
+        log.info("ShellWorker %s: Job %s finished. result: %s", s.num, s.job.name, s.job.result)
 
-    def cancel(s, job):
-        if s.process is not None and s.job==job:
-            threading.Thread(target=ShellWorker.graceful_kill, args=(s.process,)).start()
-            s.process=None
-            s.canceled=True
+        s.resources.release(s.job)
+        s.queue.wakeup()
 
-    def graceful_kill(process):
         try:
-            os.killpg(process.pid, signal.SIGTERM)
-            process.wait(config.sigterm_timeout)
-        except subprocess.TimeoutExpired:
-            log.warning("ShellWorker: killing process")
-            process.kill()
-            process.wait()
+            subprocess.check_call([s.job.cmd, "post_build"], cwd=data_dir, env=_env)
+        except subprocess.CalledProcessError:
+            log.warning("Job %s: post build script failed.", s.job.name)
+            pass
+
+        if s.canceled:
+            s.job.set_state(JobState.finished, JobResult.canceled)
+        elif s.build.timed_out:
+            s.build = None
+            s.job.set_state(JobState.finished, JobResult.timeout)
+        else:
+            ret = s.build.returncode
+            s.build = None
+            if ret == 0:
+                s.job.set_state(JobState.finished, JobResult.passed)
+            else:
+                s.job.set_state(JobState.finished, JobResult.errored)
+
+    def build_exited(s, limits, build_dir):
+        """ Called by the supervisor once the process group of a build is
+        gone. Usually the worker is still running post_build in build_dir
+        then, but a killed build can outlive its job. """
+        limits.release()
+        build_dir.release()
+
+    def time_output(s):
+        if s.build:
+            return s.build.time_output
+        return s.job.time_started
+
+    def cancel(s, job):
+        # the supervisor takes care of the process group, the worker
+        # continues as soon as the kill has been started.
+        if s.job == job and not s.canceled:
+            if s.build and s.build.done.is_set():
+                return
+            s.canceled = True
+            if s.build:
+                s.build.kill()
 
 class PullRequest(object):
+    # only the fields murdock uses are kept from the github PR payloads
+    __slots__ = ( "url", "nr", "title", "state", "user", "head", "repo",
+                  "branch", "base_repo", "base_branch", "base_commit",
+                  "base_full_name", "merge_commit", "mergeable",
+                  "current_job", "jobs", "labels", "old_head", "start_timer",
+                  "start_head" )
+
     _map = {}
 
     def __init__(s, data):
-        s.data = data
-        s._map[data["_links"]["html"]["href"]] = s
+        s.update_data(data)
+        s._map[s.url] = s
         s.current_job = None
         s.jobs = []
         s.labels = set()
         s.old_head = None
+        s.start_timer = None
+        s.start_head = None
 
     def get(data, create=True):
         if "pull_request" in data:
@@ -170,7 +209,7 @@ class PullRequest(object):
         pull_url = data["_links"]["html"]["href"]
         pr = PullRequest._map.get(pull_url)
         if pr:
-            pr.data = data
+            pr.update_data(data)
             log.info("PR %s updated", pr.url)
         else:
             if not create:
@@ -199,7 +238,20 @@ class PullRequest(object):
                 s.start_job()
         return s
 
+    def cancel_start(s, new_head=None):
+        """ Cancel a delayed start. The pending status it has posted is
+        resolved, unless a new start of the same head replaces it. """
+        if s.start_timer:
+            s.start_timer.cancel()
+            s.start_timer = None
+            if s.start_head != new_head:
+                log.info("PR %s: canceled queueing build of commit %s", s.url, s.start_head)
+                s.set_status(s.start_head, state="failure",
+                             description="The build has been canceled.",
+                             target_url=config.http_root)
+
     def cancel_job(s):
+        s.cancel_start()
         if s.current_job and s.current_job.state!=JobState.finished:
             log.info("PR %s: canceling build of commit %s", s.url, s.current_job.arg)
             s.current_job.cancel()
@@ -207,6 +259,47 @@ class PullRequest(object):
         return s
 
     def start_job(s):
+        """ Queue a build of the current head.
+
+        The build is only queued after the PR has been left alone for
+        debounce_window seconds, and a running build of a previous head is
+        only preempted after it ran for preempt_min_runtime seconds.
+        """
+        s.cancel_start(s.head)
+
+        delay = config.job_setting("debounce_window", s.base_full_name, s.labels)
+
+        job = s.current_job
+        if job and job.state == JobState.running:
+            min_runtime = config.job_setting("preempt_min_runtime", s.base_full_name, s.labels)
+            delay = max(delay, job.time_started + min_runtime - time.time())
+        elif job and job.state != JobState.finished:
+            # not started yet, no need to keep it around
+            s.cancel_job()
+
+        if delay <= 0:
+            return s.queue_job()
+
+        log.info("PR %s: queueing build of commit %s in %ss", s.url, s.head, round(delay))
+        s.set_status(s.head, state="pending",
+                     description="The build will be queued shortly.",
+                     target_url=config.http_root)
+
+        s.start_head = s.head
+        s.start_timer = threading.Timer(delay, s.delayed_start)
+        s.start_timer.daemon = True
+        s.start_timer.start()
+        return s
+
+    def delayed_start(s):
+        with handle_pull_request_lock:
+            # canceled or superseded while waiting for the lock
+            if threading.current_thread() is not s.start_timer:
+                return
+            s.start_timer = None
+            s.queue_job()
+
+    def queue_job(s):
         s.cancel_job()
 
         log.info("PR %s: queueing build of commit %s", s.url, s.head)
@@ -233,15 +326,72 @@ class PullRequest(object):
         for key, value in env.items():
             if not value:
                 log.warning("PR %s: env %s has NoneType!", s.url, key)
+                s.set_status(s.head, state="error",
+                             description="The build could not be queued (%s is not set)." % key,
+                             target_url=config.http_root)
                 return s
 
-        s.current_job = Job(s.get_job_path(s.head), os.path.join(config.scripts_dir, "build.sh"), env, s.job_hook, s.head)
+        cpus = config.job_setting("build_cpus", s.base_full_name, s.labels)
+        memory = config.job_setting("build_memory", s.base_full_name, s.labels)
+        timeout = config.job_setting("build_timeout", s.base_full_name, s.labels)
+        output_timeout = config.job_setting("output_timeout", s.base_full_name, s.labels)
+
+        build_digest = s.get_build_digest([ cpus, memory, timeout, output_timeout ])
+        if not config.rebuild_label in s.labels:
+            cached = result_cache.get(s.get_cache_key(env, build_digest))
+            if cached:
+                s.post_cached_result(cached)
+                return s
+
+        s.current_job = Job(s.get_job_path(s.head), os.path.join(config.scripts_dir, "build.sh"), env, s.job_hook, s.head,
+                            cpus, memory, timeout, output_timeout)
+        s.current_job.build_digest = build_digest
         s.jobs.append(s.current_job)
         queue.put(s.current_job)
 
         s.current_job.set_state(JobState.queued)
         return s
 
+    def get_build_digest(s, settings):
+        """ Digest of what a build depends on besides its sources: the
+        labels (passed in CI_PULL_LABELS), its job settings and the build
+        scripts. """
+        labels = sorted(s.labels - { config.ci_ready_label, config.rebuild_label })
+        data = json.dumps([ labels, settings, dir_digest(config.scripts_dir) ])
+        return hashlib.sha1(data.encode("utf-8")).hexdigest()
+
+    def get_cache_key(s, env, build_digest):
+        """ Identify what a build with env is going to build.
+
+        That is the tree of the merge commit if github provides one,
+        otherwise the pair of head and base commits, plus build_digest.
+        """
+        merge_commit = env.get("CI_MERGE_COMMIT")
+        if merge_commit:
+            try:
+                return "%s:tree:%s:%s" % (s.base_full_name,
+                        merge_tree(s.base_full_name, merge_commit), build_digest)
+            except LookupError as e:
+                log.warning("PR %s: couldn't get merge commit tree: %s", s.url, e)
+
+        return "%s:commits:%s:%s:%s" % (s.base_full_name, env["CI_PULL_COMMIT"],
+                                        env["CI_BASE_COMMIT"], build_digest)
+
+    def post_cached_result(s, cached):
+        log.info("PR %s: using cached result of commit %s", s.url, cached["commit"])
+
+        description = "The build succeeded (cached result of %s). runtime: %s" \
+                % (cached["commit"][:8], nicetime(cached["runtime"]))
+        if not s.labels & config.fail_labels:
+            state = "success"
+        else:
+            state = "error"
+            description = "The build only failed the label check (cached result of %s)." \
+                    % cached["commit"][:8]
+
+        s.set_status(s.head, state=state, description=description,
+                     target_url=cached["target_url"])
+
     def get_job_path(s, commit):
         return os.path.join(config.data_dir, s.base_full_name, str(s.nr), commit)
 
@@ -262,6 +412,8 @@ class PullRequest(object):
         s.labels.add(label)
         if label == config.ci_ready_label:
             s.start_job()
+        elif label == config.rebuild_label and config.ci_ready_label in s.labels:
+            s.start_job()
         return s
 
     def remove_label(s, label):
@@ -271,37 +423,25 @@ class PullRequest(object):
             s.cancel_job()
         return s
 
-    def __getattr__(s, field):
-        if field == "url":
-            return s.data["_links"]["html"]["href"]
-        elif field == "base_repo":
-            return s.data["base"]["repo"]["clone_url"]
-        elif field == "base_branch":
-            return s.data["base"]["ref"]
-        elif field == "base_commit":
-            return s.data["base"]["sha"]
-        elif field == "base_full_name":
-            return s.data["base"]["repo"]["full_name"]
-        elif field == "nr":
-            return s.data["number"]
-        elif field == "branch":
-            return s.data["head"]["ref"]
-        elif field == "repo":
-            return s.data["head"]["repo"]["clone_url"]
-        elif field == "head":
-            return s.data["head"]["sha"]
-        elif field == "user":
-            return s.data["head"]["user"]["login"]
-        elif field == "title":
-            return s.data["title"]
-        elif field == "state":
-            return s.data["state"]
-        elif field == "merge_commit":
-            return s.data["merge_commit_sha"]
-        elif field == "mergeable":
-            return s.data["mergeable"]
-        else:
-            raise AttributeError
+    def update_data(s, data):
+        head = data["head"]
+        base = data["base"]
+
+        s.url = data["_links"]["html"]["href"]
+        s.nr = data["number"]
+        s.title = data["title"]
+        s.state = data["state"]
+        s.user = head["user"]["login"]
+        s.head = head["sha"]
+        s.branch = head["ref"]
+        # the head repository is gone if the fork has been deleted
+        s.repo = head["repo"]["clone_url"] if head["repo"] else None
+        s.base_repo = base["repo"]["clone_url"]
+        s.base_branch = base["ref"]
+        s.base_commit = base["sha"]
+        s.base_full_name = base["repo"]["full_name"]
+        s.merge_commit = data.get("merge_commit_sha")
+        s.mergeable = data.get("mergeable")
 
     def job_hook(s, arg, job):
         target_url = None
@@ -310,11 +450,24 @@ class PullRequest(object):
             state = "pending"
             description = "The build has been queued."
         elif job.state == JobState.running:
+            # resolved only now, so the generation can't get evicted while
+            # the job waits in the queue
+            if warm_cache and not "CI_BASE_CACHE" in job.env:
+                base_cache = warm_cache.lookup(s.base_full_name,
+                        job.env["CI_BASE_BRANCH"], job.env["CI_BASE_COMMIT"])
+                if base_cache:
+                    job.env["CI_BASE_CACHE"] = base_cache
             state = "pending"
             description = "The build has been started."
         elif job.state == JobState.finished:
+            if "CI_BASE_CACHE" in job.env:
+                warm_cache.release(job.env["CI_BASE_CACHE"])
             runtime = job.time_finished - job.time_started
             target_url = os.path.join(config.http_root, s.base_full_name, str(s.nr), arg, "output.html")
+            if job.result == JobResult.passed and job.build_digest:
+                result_cache.put(s.get_cache_key(job.env, job.build_digest),
+                                 commit=arg, runtime=runtime,
+                                 target_url=target_url)
             if job.result == JobResult.passed:
                 if not s.labels & config.fail_labels:
                     state = "success"
@@ -326,6 +479,9 @@ class PullRequest(object):
             elif job.result == JobResult.errored:
                 state = "error"
                 description = "The build failed. runtime: %s" % nicetime(runtime)
+            elif job.result == JobResult.timeout:
+                state = "error"
+                description = "The build timed out. runtime: %s" % nicetime(runtime)
             else:
                 state = "failure"
                 target_url = None
@@ -462,22 +618,126 @@ def handle_pull_request(request):
 
             pr.set_status(pr_data["head"]["sha"], **status)
 
+class BaseBranch(object):
+    """ Builds the warm cache of a base branch's latest commit. """
+    _map = {}
+
+    def __init__(s, repo, branch, clone_url):
+        s.repo = repo
+        s.branch = branch
+        s.clone_url = clone_url
+        s.current_job = None
+        # unfinished jobs, a running build of an older commit keeps going
+        s.jobs = []
+        s._map[(repo, branch)] = s
+
+    def get(repo, branch, clone_url):
+        return BaseBranch._map.get((repo, branch)) or BaseBranch(repo, branch, clone_url)
+
+    def start_job(s, commit):
+        if s.current_job and s.current_job.arg == commit \
+                and s.current_job.state != JobState.finished:
+            return
+
+        # a queued build of an older commit is of no use anymore
+        if s.current_job and s.current_job.state in { JobState.created, JobState.queued }:
+            log.info("Branch %s/%s: canceling warm cache build of %s", s.repo, s.branch, s.current_job.arg)
+            s.current_job.cancel()
+
+        cache_dir = warm_cache.prepare(s.repo, commit)
+        if not cache_dir:
+            log.info("Branch %s/%s: warm cache of %s exists or is being built", s.repo, s.branch, commit)
+            return
+
+        log.info("Branch %s/%s: queueing warm cache build of commit %s", s.repo, s.branch, commit)
+
+        env = { "CI_BASE_REPO" : s.clone_url,
+                "CI_BASE_BRANCH" : s.branch,
+                "CI_BASE_COMMIT" : commit,
+                "CI_CACHE_DIR" : cache_dir,
+                "CI_SCRIPTS_DIR" : config.scripts_dir,
+                }
+
+        s.current_job = Job(os.path.join(config.data_dir, s.repo, "warm_cache", commit),
+                            os.path.join(config.scripts_dir, "build.sh"), env, s.job_hook, commit,
+                            config.job_setting("build_cpus", s.repo, ()),
+                            config.job_setting("build_memory", s.repo, ()),
+                            config.job_setting("build_timeout", s.repo, ()),
+                            config.job_setting("output_timeout", s.repo, ()),
+                            action="warm_cache", priority=-1)
+        s.jobs = [ job for job in s.jobs if job.state != JobState.finished ]
+        s.jobs.append(s.current_job)
+        queue.put(s.current_job)
+        s.current_job.set_state(JobState.queued)
+
+    def job_hook(s, commit, job):
+        if job.state != JobState.finished:
+            return
+
+        if job.result == JobResult.passed:
+            try:
+                warm_cache.publish(s.repo, s.branch, commit)
+            except OSError as e:
+                log.warning("Branch %s/%s: cannot publish warm cache of %s: %s", s.repo, s.branch, commit, e)
+        else:
+            log.warning("Branch %s/%s: warm cache build of %s: %s", s.repo, s.branch, commit, job.result)
+            warm_cache.discard(s.repo, commit)
+
+    def cancel_all():
+        log.info("canceling warm cache builds...")
+        for branch in BaseBranch._map.values():
+            for job in branch.jobs:
+                if job.state != JobState.finished:
+                    job.cancel()
+
 def handle_push(request):
     data = json.loads(request.body.decode("utf-8"))
 
-    log.info(json.dumps(data, sort_keys=False, indent=4))
+    repo = data["repository"]["full_name"]
+    if not repo in config.repos:
+        log.warning("ignoring push to repo %s", repo)
+        return
+
+    if not warm_cache or data.get("deleted") or not data["ref"].startswith("refs/heads/"):
+        return
+
+    branch = data["ref"][len("refs/heads/"):]
+    branches = config.warm_cache_branches or [ data["repository"]["default_branch"] ]
+    if not branch in branches:
+        return
+
+    with handle_pull_request_lock:
+        BaseBranch.get(repo, branch, data["repository"]["clone_url"]).start_job(data["after"])
 
 github_handlers = {
         "pull_request" : handle_pull_request,
-#        "push" : handle_push,
+        "push" : handle_push,
         }
 if not (bool(config.github_username and config.github_password) ^ bool(config.github_apikey)):
     raise SystemExit("No valid github authentication provided, provide "
                      "username/password or an API key in the configuration "
                      "file.")
 github = GitHub(config.github_username, config.github_password, token=config.github_apikey)
-queue = Queue()
-ShellWorker(queue)
+result_cache = ResultCache(os.path.join(config.data_dir, "result_cache.json"), config.result_cache_size)
+if config.warm_cache_dir:
+    warm_cache = WarmCache(config.warm_cache_dir, config.warm_cache_size, config.warm_cache_keep)
+else:
+    warm_cache = None
+if config.cgroup_dir:
+    try:
+        enable_controllers(config.cgroup_dir)
+    except OSError as e:
+        raise SystemExit("Cannot use cgroup_dir %s: %s" % (config.cgroup_dir, e))
+queue = JobQueue(config.max_job_skips)
+resources = Resources(config.cpus, config.memory)
+supervisor = Supervisor(config.sigterm_timeout)
+for i in range(config.local_workers):
+    ShellWorker(queue, resources, supervisor)
+
+if config.agent_token:
+    agents = RemoteWorkerPool(queue)
+else:
+    agents = None
 
 def shutdown():
     global ioloop
@@ -501,12 +761,15 @@ def main():
 
 #    threading.Thread(target=startup_load_pull_requests, daemon=True).start()
 
-    g = GithubWebhook(config.port, PullRequest, github_handlers)
+    g = GithubWebhook(config.port, PullRequest, github_handlers, agents)
     global ioloop
     ioloop = g.ioloop
     g.run()
 
     # tornado loop ended
 
+    queue.close()
     PullRequest.cancel_all()
+    BaseBranch.cancel_all()
+    supervisor.drain()
     log.info("murdock shut down.")
@@ -0,0 +1,160 @@
+import os
+import subprocess
+import threading
+import time
+import uuid
+
+from threading import Lock
+
+from .log import log
+from .jobs import JobResult, JobState
+from .scheduler import Resources
+from .util import config
+
+
+class RemoteLease(object):
+    """ A job handed out to a remote build agent.
+
+    The lease takes the place of a ShellWorker as the job's worker. It has to
+    be renewed (by heartbeats or output uploads) within
+    config.agent_lease_timeout, otherwise the job gets re-queued.
+    """
+    def __init__(s, job, agent, cpus, memory):
+        s.id = uuid.uuid4().hex
+        s.job = job
+        s.agent = agent
+        s.cpus = cpus
+        s.memory = memory
+        s.canceled = False
+        s.last_output = time.time()
+        s.output_file = open(os.path.join(job.data_dir(), "output.txt"), mode='wb')
+        s.renew()
+
+    def renew(s):
+        s.expires = time.time() + config.agent_lease_timeout
+
+    def time_output(s):
+        return s.last_output
+
+    def cancel(s, job):
+        # the agent learns about this with its next heartbeat
+        if s.job == job:
+            s.canceled = True
+
+    def describe(s):
+        return {
+                "lease" : s.id,
+                "name" : s.job.name,
+                "env" : s.job.env,
+                "cpus" : s.cpus,
+                "memory" : s.memory,
+                "timeout" : s.job.timeout,
+                "output_timeout" : s.job.output_timeout,
+                }
+
+
+class RemoteWorkerPool(object):
+    def __init__(s, queue):
+        s.queue = queue
+        s.lock = Lock()
+        s.leases = {}
+        threading.Thread(target=s.expire_leases, daemon=True).start()
+
+    def get(s, lease_id):
+        with s.lock:
+            return s.leases.get(lease_id)
+
+    def lease(s, agent, cpus, memory):
+        # an agent builds one job at a time, so its share of its host is
+        # computed against an otherwise idle host.
+        # other actions (warm cache builds) write to the murdock host and
+        # are left to local workers.
+        resources = Resources(cpus, memory)
+        job = s.queue.get_nowait(lambda job: job.action == "build" and resources.try_acquire(job))
+        if not job:
+            return None
+
+        cpus, memory = resources.allocation(job)
+        log.info("RemoteWorkerPool: agent %s leased job %s (cpus: %s, memory: %s)", agent, job.name, cpus, memory)
+
+        os.makedirs(job.data_dir(), exist_ok=True)
+
+        lease = RemoteLease(job, agent, cpus, memory)
+        with s.lock:
+            s.leases[lease.id] = lease
+
+        job.worker = lease
+        job.set_state(JobState.running)
+        job.env["CI_BUILD_ID"] = str(job.time_started)
+        job.env["CI_JOBS"] = str(cpus)
+
+        return lease
+
+    def output(s, lease, data):
+        lease.renew()
+        if data:
+            lease.last_output = time.time()
+        lease.output_file.write(data)
+        lease.output_file.flush()
+
+    def finish(s, lease, result):
+        with s.lock:
+            if s.leases.pop(lease.id, None) is None:
+                return
+
+        lease.output_file.close()
+
+        if lease.canceled:
+            result = JobResult.canceled
+
+        log.info("RemoteWorkerPool: agent %s finished job %s. result: %s", lease.agent, lease.job.name, result)
+
+        threading.Thread(target=s.post_build, args=(lease.job, result), daemon=True).start()
+
+    def post_build(s, job, result):
+        _env = os.environ.copy()
+        _env.update(job.env)
+
+        try:
+            subprocess.check_call([job.cmd, "post_build"], cwd=job.data_dir(), env=_env)
+        except subprocess.CalledProcessError:
+            log.warning("Job %s: post build script failed.", job.name)
+
+        job.set_state(JobState.finished, result)
+
+    def release(s, lease):
+        """ give back the job of an agent that is shutting down """
+        with s.lock:
+            if s.leases.pop(lease.id, None) is None:
+                return
+
+        log.info("RemoteWorkerPool: agent %s gave back job %s", lease.agent, lease.job.name)
+        s.requeue(lease)
+
+    def requeue(s, lease):
+        job = lease.job
+        lease.output_file.close()
+        job.worker = None
+        if lease.canceled:
+            job.set_state(JobState.finished, JobResult.canceled)
+        else:
+            job.set_state(JobState.queued)
+            s.queue.put(job)
+
+    def expire_leases(s):
+        while True:
+            time.sleep(max(1, config.agent_lease_timeout / 4))
+            s.expire(time.time())
+
+    def expire(s, now):
+        with s.lock:
+            expired = [ lease for lease in s.leases.values() if lease.expires < now ]
+            for lease in expired:
+                del s.leases[lease.id]
+
+        for lease in expired:
+            if lease.canceled:
+                log.warning("RemoteWorkerPool: lease of canceled job %s expired (agent %s)", lease.job.name, lease.agent)
+            else:
+                log.warning("RemoteWorkerPool: lease of job %s expired (agent %s), re-queueing", lease.job.name, lease.agent)
+            s.requeue(lease)
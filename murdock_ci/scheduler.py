@@ -0,0 +1,120 @@
+from threading import Condition, Lock
+
+from .jobs import JobState
+
+
+class JobQueue(object):
+    """ Priority job queue that hands out the first job accepted by a predicate.
+
+    Jobs of the same priority are handed out first in, first out.
+
+    Workers pass their Resources.try_acquire() as predicate, so smaller jobs
+    can be started while a bigger one waits for resources to become free.
+    Once a job has been skipped max_skips times (0 means no limit), no job
+    queued behind it is handed out before it, so the resources released by
+    finishing jobs add up for it. Finished (canceled) jobs are dropped from
+    the queue. Once closed, no more jobs are handed out.
+    """
+    def __init__(s, max_skips=0):
+        s.cond = Condition()
+        s.jobs = []
+        s.closed = False
+        s.max_skips = max_skips
+        s.skips = {}
+
+    def put(s, job):
+        with s.cond:
+            n = len(s.jobs)
+            while n and s.jobs[n - 1].priority < job.priority:
+                n -= 1
+            s.jobs.insert(n, job)
+            s.cond.notify_all()
+
+    def _take(s, fits):
+        if s.closed:
+            return None
+        s.jobs = [ job for job in s.jobs if job.state != JobState.finished ]
+        s.skips = { job.id : s.skips[job.id] for job in s.jobs if job.id in s.skips }
+        for n, job in enumerate(s.jobs):
+            if fits is None or fits(job):
+                for skipped in s.jobs[:n]:
+                    s.skips[skipped.id] = s.skips.get(skipped.id, 0) + 1
+                s.skips.pop(job.id, None)
+                return s.jobs.pop(n)
+            if s.max_skips and s.skips.get(job.id, 0) >= s.max_skips:
+                break
+        return None
+
+    def get(s, fits=None):
+        """ Wait for a job accepted by fits. Returns None once closed. """
+        with s.cond:
+            while not s.closed:
+                job = s._take(fits)
+                if job:
+                    return job
+                s.cond.wait()
+            return None
+
+    def get_nowait(s, fits=None):
+        with s.cond:
+            return s._take(fits)
+
+    def close(s):
+        with s.cond:
+            s.closed = True
+            s.cond.notify_all()
+
+    def wakeup(s):
+        """ notify waiting workers that resources have been released """
+        with s.cond:
+            s.cond.notify_all()
+
+    def __len__(s):
+        with s.cond:
+            return len(s.jobs)
+
+
+class Resources(object):
+    """ CPU (cores) and memory (MiB) budget of a worker host.
+
+    Jobs asking for more than the host has are clamped to the host size, so
+    they get the whole host instead of never being scheduled. A memory
+    budget of 0 means memory is not accounted.
+    """
+    def __init__(s, cpus, memory=0):
+        s.lock = Lock()
+        s.cpus = cpus
+        s.memory = memory
+        s.used_cpus = 0
+        s.used_memory = 0
+        s.allocations = {}
+
+    def share(s, job):
+        cpus = max(1, min(job.cpus, s.cpus))
+        if s.memory:
+            memory = min(job.memory, s.memory)
+        else:
+            memory = job.memory
+        return cpus, memory
+
+    def try_acquire(s, job):
+        cpus, memory = s.share(job)
+        with s.lock:
+            if s.used_cpus + cpus > s.cpus:
+                return False
+            if s.memory and s.used_memory + memory > s.memory:
+                return False
+            s.used_cpus += cpus
+            s.used_memory += memory
+            s.allocations[job.id] = (cpus, memory)
+            return True
+
+    def allocation(s, job):
+        with s.lock:
+            return s.allocations.get(job.id)
+
+    def release(s, job):
+        with s.lock:
+            cpus, memory = s.allocations.pop(job.id, (0, 0))
+            s.used_cpus -= cpus
+            s.used_memory -= memory
@@ -0,0 +1,287 @@
+import os
+import selectors
+import shutil
+import signal
+import subprocess
+import threading
+import time
+
+from threading import Event, Lock
+
+from .log import log
+
+
+class BuildDir(object):
+    """ Working directory of a build.
+
+    It is used by the build's process group and by the worker running the
+    build (e.g., for post_build), and gets removed once both released it.
+    As a killed process group can outlive its job, a new build in the same
+    place has to wait for that (see acquire()).
+    """
+    _lock = Lock()
+    _dirs = {}
+
+    def __init__(s, path):
+        s.path = path
+        s.users = 2
+        s.removed = Event()
+
+    def acquire(path):
+        """ Get a fresh directory at path, once a previous build in there
+        is gone. """
+        while True:
+            with BuildDir._lock:
+                previous = BuildDir._dirs.get(path)
+                if not previous:
+                    build_dir = BuildDir._dirs[path] = BuildDir(path)
+                    break
+            log.info("BuildDir: waiting for previous build in %s to exit", path)
+            previous.removed.wait()
+
+        try:
+            shutil.rmtree(path, ignore_errors=True)
+            os.makedirs(path)
+        except OSError:
+            build_dir.users = 1
+            build_dir.release()
+            raise
+        return build_dir
+
+    def release(s):
+        with BuildDir._lock:
+            s.users -= 1
+            if s.users:
+                return
+        shutil.rmtree(s.path, ignore_errors=True)
+        with BuildDir._lock:
+            if BuildDir._dirs.get(s.path) is s:
+                del BuildDir._dirs[s.path]
+        s.removed.set()
+
+
+class BuildProcess(object):
+    """ Handle of a build process group run by the Supervisor. """
+    def __init__(s, supervisor, process, output, on_exit, timeout, output_timeout):
+        s.supervisor = supervisor
+        s.process = process
+        s.output = output
+        s.on_exit = on_exit
+        s.timeout = timeout
+        s.output_timeout = output_timeout
+        s.time_started = s.time_output = time.time()
+        s.pidfd = None
+        s.output_closed = False
+        s.killed = False
+        s.timed_out = False
+        s.abandoned = False
+        s.kill_deadline = None
+        s.done = Event()
+
+    def deadline(s):
+        """ time at which the build times out, None if it can't """
+        deadlines = []
+        if s.timeout:
+            deadlines.append(s.time_started + s.timeout)
+        if s.output_timeout:
+            deadlines.append(s.time_output + s.output_timeout)
+        return min(deadlines) if deadlines else None
+
+    def wait(s, timeout=None):
+        """ Wait until the build exited and its output has been read, or
+        until it got killed. Returns True if so. """
+        return s.done.wait(timeout)
+
+    def kill(s):
+        s.supervisor.kill(s)
+
+    @property
+    def returncode(s):
+        return s.process.returncode
+
+
+class Supervisor(threading.Thread):
+    """ Single thread watching all build process groups.
+
+    It collects the output of every build, notices process exits (using
+    pidfds where available, polling otherwise) and terminates process groups
+    on request or when they time out, escalating SIGTERM to SIGKILL after
+    sigterm_timeout seconds. Builds time out after running for longer than
+    timeout seconds or not writing output for output_timeout seconds (0
+    disables either). A killed build is considered done right away, the
+    supervisor keeps reaping it in the background. A build that causes an
+    error (e.g., its output can't be written) is killed and left alone.
+    """
+    def __init__(s, sigterm_timeout):
+        threading.Thread.__init__(s, daemon=True)
+        s.sigterm_timeout = sigterm_timeout
+        s.selector = selectors.DefaultSelector()
+        s.lock = Lock()
+        s.commands = []
+        s.builds = set()
+        s.idle = Event()
+        s.idle.set()
+        s.wakeup_r, s.wakeup_w = os.pipe()
+        os.set_blocking(s.wakeup_r, False)
+        s.selector.register(s.wakeup_r, selectors.EVENT_READ)
+        s.start()
+
+    def spawn(s, args, output, on_exit=None, timeout=0, output_timeout=0, **kwargs):
+        """ Start a build in a new session, writing its stdout and stderr to
+        output. on_exit is called once the process group is gone. """
+        process = subprocess.Popen(args, stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT,
+                                   start_new_session=True, **kwargs)
+        build = BuildProcess(s, process, output, on_exit, timeout, output_timeout)
+        s.command(s._add, build)
+        return build
+
+    def kill(s, build):
+        s.command(s._kill, build)
+
+    def drain(s):
+        """ Wait until all process groups have been reaped. """
+        s.idle.wait()
+
+    def command(s, func, build):
+        with s.lock:
+            s.commands.append((func, build))
+            s.idle.clear()
+        os.write(s.wakeup_w, b"x")
+
+    def _add(s, build):
+        s.builds.add(build)
+        os.set_blocking(build.process.stdout.fileno(), False)
+        s.selector.register(build.process.stdout, selectors.EVENT_READ, ("output", build))
+        if hasattr(os, "pidfd_open"):
+            try:
+                build.pidfd = os.pidfd_open(build.process.pid)
+                s.selector.register(build.pidfd, selectors.EVENT_READ, ("exit", build))
+            except OSError:
+                build.pidfd = None
+
+    def _kill(s, build):
+        if build.killed or build.done.is_set():
+            return
+        build.killed = True
+        build.kill_deadline = time.time() + s.sigterm_timeout
+        s.send_signal(build, signal.SIGTERM)
+        build.done.set()
+
+    def send_signal(s, build, sig):
+        try:
+            os.killpg(build.process.pid, sig)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+    def read_output(s, build):
+        try:
+            data = os.read(build.process.stdout.fileno(), 65536)
+        except BlockingIOError:
+            return
+        if data:
+            build.time_output = time.time()
+            if not build.killed:
+                build.output.write(data)
+        else:
+            s.selector.unregister(build.process.stdout)
+            build.process.stdout.close()
+            build.output_closed = True
+
+    def reap(s, build):
+        if build.pidfd is not None:
+            s.selector.unregister(build.pidfd)
+            os.close(build.pidfd)
+            build.pidfd = None
+        build.process.poll()
+
+    def finish(s, build):
+        s.builds.discard(build)
+        if build.on_exit:
+            try:
+                build.on_exit()
+            except Exception as e:
+                log.warning("Supervisor: on_exit failed: %s", e)
+        build.done.set()
+
+    def abandon(s, build, e):
+        """ Stop supervising a build after an error, killing it. """
+        if build.abandoned:
+            return
+        build.abandoned = True
+        log.warning("Supervisor: giving up on process group %s: %s", build.process.pid, e)
+        s.send_signal(build, signal.SIGKILL)
+        for fileobj in (build.process.stdout, build.pidfd):
+            try:
+                s.selector.unregister(fileobj)
+            except (KeyError, ValueError):
+                pass
+        build.process.stdout.close()
+        if build.pidfd is not None:
+            os.close(build.pidfd)
+            build.pidfd = None
+        s.finish(build)
+
+    def timeout(s):
+        if not s.builds:
+            return None
+        if any(build.pidfd is None for build in s.builds):
+            # without pidfds, exits are noticed by polling
+            return 1
+        deadlines = [ build.kill_deadline for build in s.builds if build.kill_deadline ]
+        deadlines += [ build.deadline() for build in s.builds
+                       if not build.killed and build.deadline() ]
+        if deadlines:
+            return max(0, min(deadlines) - time.time())
+        return None
+
+    def run(s):
+        while True:
+            for key, mask in s.selector.select(s.timeout()):
+                if key.data is None:
+                    os.read(s.wakeup_r, 4096)
+                    continue
+                kind, build = key.data
+                try:
+                    if kind == "output":
+                        s.read_output(build)
+                    else:
+                        s.reap(build)
+                except Exception as e:
+                    s.abandon(build, e)
+
+            with s.lock:
+                commands, s.commands = s.commands, []
+            for func, build in commands:
+                try:
+                    func(build)
+                except Exception as e:
+                    s.abandon(build, e)
+
+            now = time.time()
+            for build in list(s.builds):
+                try:
+                    if build.process.returncode is None and build.pidfd is None:
+                        build.process.poll()
+
+                    deadline = build.deadline()
+                    if not build.killed and deadline and deadline < now:
+                        log.warning("Supervisor: process group %s timed out", build.process.pid)
+                        build.timed_out = True
+                        s._kill(build)
+
+                    if build.kill_deadline and build.kill_deadline < now:
+                        log.warning("Supervisor: killing process group %s", build.process.pid)
+                        s.send_signal(build, signal.SIGKILL)
+                        build.kill_deadline = None
+
+                    if build.process.returncode is None or not build.output_closed:
+                        continue
+
+                    s.finish(build)
+                except Exception as e:
+                    s.abandon(build, e)
+
+            with s.lock:
+                if not s.builds and not s.commands:
+                    s.idle.set()
@@ -3,6 +3,13 @@ import sys
 
 from .config import Config
 
+def host_memory():
+    """ physical memory of this host in MiB """
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") // (1024 * 1024)
+    except (ValueError, OSError):
+        return 0
+
 class MurdockConfig(Config):
     def set_defaults(s):
         super().set_defaults()
@@ -16,6 +23,44 @@ class MurdockConfig(Config):
         s.set_default("github_username", None)
         s.set_default("github_password", None)
         s.set_default("github_apikey", None)
+        s.set_default("local_workers", 1)
+        s.set_default("cpus", os.cpu_count() or 1)
+        s.set_default("memory", host_memory())
+        s.set_default("build_cpus", s.config["cpus"])
+        s.set_default("build_memory", 0)
+        s.set_default("cgroup_dir", None)
+        s.set_default("max_job_skips", 10)
+        s.set_default("repo_settings", {})
+        s.set_default("label_settings", {})
+        s.set_default("rebuild_label", "CI: force rebuild")
+        s.set_default("result_cache_size", 10000)
+        s.set_default("debounce_window", 0)
+        s.set_default("preempt_min_runtime", 0)
+        s.set_default("build_timeout", 0)
+        s.set_default("output_timeout", 0)
+        s.set_default("warm_cache_dir", None)
+        s.set_default("warm_cache_branches", None)
+        s.set_default("warm_cache_size", 10240)
+        s.set_default("warm_cache_keep", 10)
+        s.set_default("agent_token", None)
+        s.set_default("agent_lease_timeout", 60)
+
+    def job_setting(s, key, repo, labels):
+        """ Get a per-job setting.
+
+        Settings of labels (the highest value if several labels set it)
+        override repository settings, which override the global value.
+        """
+        values = [ s.label_settings[label][key] for label in labels
+                   if key in s.label_settings.get(label, {}) ]
+        if values:
+            return max(values)
+
+        repo_settings = s.repo_settings.get(repo, {})
+        if key in repo_settings:
+            return repo_settings[key]
+
+        return s.config[key]
 
 if len(sys.argv) > 1:
     config_file = sys.argv[1]
@@ -0,0 +1,166 @@
+import json
+import os
+import shutil
+import time
+
+from threading import Lock
+
+from .log import log
+
+
+def dir_size(path):
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return size
+
+
+class WarmCache(object):
+    """ Build state of base branch commits, reusable by PR builds.
+
+    Each generation lives in <root>/<repo>/<commit>. It is filled by a
+    "warm_cache" build into a temporary directory, which only gets published
+    if that build passes. Generations are evicted least recently used first
+    once there are more than keep of them or they take more than size MiB,
+    except for the latest one of each branch and the ones that are in use
+    (handed out by lookup() and not yet released).
+    """
+    def __init__(s, root, size, keep):
+        s.lock = Lock()
+        s.root = root
+        s.size = size * 1024 * 1024
+        s.keep = keep
+        s.index_file = os.path.join(root, "index.json")
+        s.entries = {}
+        # generations being built / number of users of a generation
+        s.building = set()
+        s.pins = {}
+        os.makedirs(root, exist_ok=True)
+        s.load()
+
+    def load(s):
+        try:
+            with open(s.index_file, "r") as f:
+                s.entries = json.load(f)
+        except FileNotFoundError:
+            pass
+        except ValueError as e:
+            log.warning("WarmCache: ignoring corrupt index %s: %s", s.index_file, e)
+
+    def save(s):
+        tmpfile = s.index_file + ".tmp"
+        with open(tmpfile, "w") as f:
+            json.dump(s.entries, f)
+        os.replace(tmpfile, s.index_file)
+
+    def path(s, repo, commit):
+        return os.path.join(s.root, repo, commit)
+
+    def prepare(s, repo, commit):
+        """ Get a fresh directory to build the cache of commit in.
+
+        Returns None if that commit is already cached or being built. Once
+        the build is done, the directory has to be published or discarded.
+        """
+        key = "%s/%s" % (repo, commit)
+        with s.lock:
+            if key in s.entries or key in s.building:
+                return None
+            s.building.add(key)
+
+        tmpdir = s.path(repo, commit) + ".tmp"
+        try:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+            os.makedirs(tmpdir)
+        except OSError:
+            with s.lock:
+                s.building.discard(key)
+            raise
+        return tmpdir
+
+    def publish(s, repo, branch, commit):
+        key = "%s/%s" % (repo, commit)
+        path = s.path(repo, commit)
+        try:
+            shutil.rmtree(path, ignore_errors=True)
+            os.rename(path + ".tmp", path)
+        except OSError:
+            s.discard(repo, commit)
+            raise
+
+        now = time.time()
+        with s.lock:
+            s.building.discard(key)
+            s.entries[key] = {
+                    "repo" : repo,
+                    "branch" : branch,
+                    "commit" : commit,
+                    "created" : now,
+                    "last_used" : now,
+                    "size" : dir_size(path),
+                    }
+            log.info("WarmCache: published %s/%s (branch %s)", repo, commit, branch)
+            s.evict()
+            s.save()
+
+    def discard(s, repo, commit):
+        shutil.rmtree(s.path(repo, commit) + ".tmp", ignore_errors=True)
+        with s.lock:
+            s.building.discard("%s/%s" % (repo, commit))
+
+    def lookup(s, repo, branch, commit):
+        """ Get the cache of commit, or else the latest one of branch.
+
+        The returned generation is not evicted until it is passed to
+        release().
+        """
+        with s.lock:
+            entry = s.entries.get("%s/%s" % (repo, commit))
+            if not entry:
+                candidates = [ e for e in s.entries.values()
+                               if e["repo"] == repo and e["branch"] == branch ]
+                if not candidates:
+                    return None
+                entry = max(candidates, key=lambda e: e["created"])
+
+            key = "%s/%s" % (repo, entry["commit"])
+            s.pins[key] = s.pins.get(key, 0) + 1
+            entry["last_used"] = time.time()
+            try:
+                s.save()
+            except OSError as e:
+                log.warning("WarmCache: cannot write %s: %s", s.index_file, e)
+
+            return s.path(repo, entry["commit"])
+
+    def release(s, path):
+        """ Release a generation returned by lookup(). """
+        key = os.path.relpath(path, s.root)
+        with s.lock:
+            pins = s.pins.pop(key, 0) - 1
+            if pins > 0:
+                s.pins[key] = pins
+
+    def evict(s):
+        latest = {}
+        for key, entry in s.entries.items():
+            branch = (entry["repo"], entry["branch"])
+            if branch not in latest or entry["created"] > s.entries[latest[branch]]["created"]:
+                latest[branch] = key
+
+        protected = set(latest.values()) | set(s.pins)
+        candidates = sorted((key for key in s.entries if key not in protected),
+                            key=lambda key: s.entries[key]["last_used"])
+
+        total = sum(entry["size"] for entry in s.entries.values())
+        for key in candidates:
+            if len(s.entries) <= s.keep and total <= s.size:
+                break
+            entry = s.entries.pop(key)
+            total -= entry["size"]
+            log.info("WarmCache: evicting %s", key)
+            shutil.rmtree(s.path(entry["repo"], entry["commit"]), ignore_errors=True)
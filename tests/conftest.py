@@ -0,0 +1,24 @@
+import os
+import sys
+import tempfile
+
+# murdock_ci.util loads the configuration file named on the command line
+# when it gets imported, point it to a test configuration.
+test_dir = tempfile.mkdtemp(prefix="murdock-test-")
+scripts_dir = os.path.join(test_dir, "scripts")
+os.makedirs(scripts_dir)
+with open(os.path.join(scripts_dir, "build.sh"), "w") as f:
+    f.write("#!/bin/sh\nexit 0\n")
+os.chmod(os.path.join(scripts_dir, "build.sh"), 0o755)
+
+config_file = os.path.join(test_dir, "murdock.toml")
+with open(config_file, "w") as f:
+    f.write('data_dir = "%s"\n' % os.path.join(test_dir, "data"))
+    f.write('scripts_dir = "%s"\n' % scripts_dir)
+    f.write('http_root = "http://ci.example.com"\n')
+    f.write('github_apikey = "test"\n')
+    f.write('repos = [ "org/repo" ]\n')
+    f.write('set_status = true\n')
+    f.write('local_workers = 0\n')
+
+sys.argv = [ sys.argv[0], config_file ]
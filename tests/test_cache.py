@@ -0,0 +1,40 @@
+import os
+
+from murdock_ci.cache import ResultCache, dir_digest
+
+
+def test_oldest_entries_are_dropped(tmp_path):
+    cache = ResultCache(str(tmp_path / "cache.json"), 2)
+    cache.put("a", commit="1")
+    cache.put("b", commit="2")
+    cache.put("a", commit="3")
+    cache.put("c", commit="4")
+
+    assert cache.get("b") is None
+    assert cache.get("a") == { "commit" : "3" }
+    assert cache.get("c") == { "commit" : "4" }
+
+
+def test_cache_is_persistent(tmp_path):
+    filename = str(tmp_path / "cache.json")
+    ResultCache(filename, 10).put("a", commit="1")
+
+    assert ResultCache(filename, 10).get("a") == { "commit" : "1" }
+
+
+def test_corrupt_cache_is_ignored(tmp_path):
+    filename = tmp_path / "cache.json"
+    filename.write_text("{")
+
+    assert ResultCache(str(filename), 10).get("a") is None
+
+
+def test_dir_digest(tmp_path):
+    os.makedirs(str(tmp_path / "sub"))
+    (tmp_path / "build.sh").write_text("echo 1")
+    (tmp_path / "sub" / "lib.sh").write_text("x")
+    digest = dir_digest(str(tmp_path))
+
+    assert dir_digest(str(tmp_path)) == digest
+    (tmp_path / "build.sh").write_text("echo 2")
+    assert dir_digest(str(tmp_path)) != digest
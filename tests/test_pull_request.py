@@ -0,0 +1,243 @@
+import time
+
+import pytest
+
+pytest.importorskip("pytoml")
+pytest.importorskip("tornado")
+pytest.importorskip("agithub")
+
+from murdock_ci import murdock
+from murdock_ci.cache import ResultCache
+from murdock_ci.jobs import JobResult, JobState
+from murdock_ci.scheduler import JobQueue
+from murdock_ci.util import config
+
+
+class FakeGitHub(object):
+    """ records the requests murdock makes """
+    def __init__(s, path=(), calls=None):
+        s.path = path
+        s.calls = [] if calls is None else calls
+
+    def __getattr__(s, name):
+        return FakeGitHub(s.path + (name,), s.calls)
+
+    def __getitem__(s, key):
+        return FakeGitHub(s.path + (key,), s.calls)
+
+    def get(s):
+        s.calls.append(("get",) + s.path)
+        if "commits" in s.path:
+            return 200, { "tree" : { "sha" : "tree-%s" % s.path[-1] } }
+        return 404, None
+
+    def post(s, body):
+        s.calls.append(("post",) + s.path + (body,))
+        return 201, {}
+
+    def posted_statuses(s):
+        return [ (call[-2], call[-1]["state"], call[-1]["description"])
+                 for call in s.calls if call[0] == "post" ]
+
+
+@pytest.fixture
+def github(monkeypatch, tmp_path):
+    github = FakeGitHub()
+    monkeypatch.setattr(murdock, "github", github)
+    monkeypatch.setattr(murdock, "queue", JobQueue())
+    monkeypatch.setattr(murdock, "result_cache", ResultCache(str(tmp_path / "cache.json"), 100))
+    monkeypatch.setattr(murdock, "warm_cache", None)
+    murdock.merge_tree.cache_clear()
+    return github
+
+
+def pr_data(nr, head="head1"):
+    return {
+        "_links" : { "html" : { "href" : "https://github.com/org/repo/pull/%s" % nr } },
+        "number" : nr,
+        "title" : "title",
+        "state" : "open",
+        "head" : { "sha" : head, "ref" : "branch", "user" : { "login" : "user" },
+                   "repo" : { "clone_url" : "https://github.com/user/repo" } },
+        "base" : { "sha" : "base1", "ref" : "master",
+                   "repo" : { "clone_url" : "https://github.com/org/repo",
+                              "full_name" : "org/repo" } },
+        "merge_commit_sha" : "merge-%s" % head,
+        "mergeable" : True,
+        }
+
+
+def new_pr(nr, head="head1"):
+    pr = murdock.PullRequest(pr_data(nr, head))
+    pr.labels = { config.ci_ready_label }
+    return pr
+
+
+def debounce(monkeypatch, seconds):
+    monkeypatch.setitem(config.config, "debounce_window", seconds)
+
+
+def test_no_debounce_queues_right_away(github):
+    pr = new_pr(1)
+    pr.start_job()
+
+    assert len(murdock.queue) == 1
+    assert pr.current_job.state == JobState.queued
+    assert github.posted_statuses() == [ ("head1", "pending", "The build has been queued.") ]
+
+
+def test_debounce_delays_queueing(github, monkeypatch):
+    debounce(monkeypatch, 0.2)
+    pr = new_pr(2)
+    pr.start_job()
+
+    assert len(murdock.queue) == 0
+    assert github.posted_statuses() == [ ("head1", "pending", "The build will be queued shortly.") ]
+
+    time.sleep(0.5)
+    assert len(murdock.queue) == 1
+    assert github.posted_statuses()[-1] == ("head1", "pending", "The build has been queued.")
+
+
+def test_canceled_start_posts_canceled(github, monkeypatch):
+    debounce(monkeypatch, 0.2)
+    pr = new_pr(3)
+    pr.start_job()
+    pr.remove_label(config.ci_ready_label)
+
+    time.sleep(0.5)
+    assert len(murdock.queue) == 0
+    assert github.posted_statuses() == [
+            ("head1", "pending", "The build will be queued shortly."),
+            ("head1", "failure", "The build has been canceled."),
+            ]
+
+
+def test_restart_keeps_pending_status(github, monkeypatch):
+    debounce(monkeypatch, 0.2)
+    pr = new_pr(4)
+    pr.start_job()
+    pr.start_job()
+
+    time.sleep(0.5)
+    assert len(murdock.queue) == 1
+    assert [ status[1] for status in github.posted_statuses() ] == [ "pending" ] * 3
+
+
+def test_new_head_cancels_start_of_old_head(github, monkeypatch):
+    debounce(monkeypatch, 0.2)
+    pr = new_pr(5)
+    pr.start_job()
+    pr.update_data(pr_data(5, "head2"))
+    pr.start_job()
+
+    time.sleep(0.5)
+    assert len(murdock.queue) == 1
+    assert pr.current_job.arg == "head2"
+    assert github.posted_statuses()[:3] == [
+            ("head1", "pending", "The build will be queued shortly."),
+            ("head1", "failure", "The build has been canceled."),
+            ("head2", "pending", "The build will be queued shortly."),
+            ]
+
+
+def test_running_build_is_preempted_late(github, monkeypatch):
+    monkeypatch.setitem(config.config, "preempt_min_runtime", 60)
+    pr = new_pr(6)
+    pr.start_job()
+    running = pr.current_job
+    murdock.queue.get_nowait()
+    running.set_state(JobState.running)
+
+    pr.update_data(pr_data(6, "head2"))
+    pr.start_job()
+
+    assert running.state == JobState.running
+    assert pr.start_timer is not None
+    pr.cancel_start()
+
+
+def test_missing_env_posts_error(github):
+    pr = new_pr(7)
+    pr.repo = None
+    pr.start_job()
+
+    assert len(murdock.queue) == 0
+    assert github.posted_statuses() == [ ("head1", "error",
+            "The build could not be queued (CI_PULL_REPO is not set).") ]
+
+
+def build(pr, result=JobResult.passed):
+    job = murdock.queue.get_nowait()
+    assert job is pr.current_job
+    job.set_state(JobState.running)
+    job.set_state(JobState.finished, result)
+
+
+def tree_lookups(github):
+    return [ call for call in github.calls if call[0] == "get" and "commits" in call ]
+
+
+def test_passed_build_is_cached(github):
+    pr = new_pr(10)
+    pr.start_job()
+    build(pr)
+
+    pr.start_job()
+    assert len(murdock.queue) == 0
+    assert github.posted_statuses()[-1] == ("head1", "success",
+            "The build succeeded (cached result of head1). runtime: 0s")
+    # the merge commit's tree is looked up once
+    assert len(tree_lookups(github)) == 1
+
+
+def test_failed_build_is_not_cached(github):
+    pr = new_pr(11)
+    pr.start_job()
+    build(pr, JobResult.errored)
+
+    pr.start_job()
+    assert len(murdock.queue) == 1
+
+
+def test_labels_are_part_of_the_key(github):
+    pr = new_pr(12)
+    pr.start_job()
+    build(pr)
+
+    pr.labels.add("CI: run tests")
+    pr.start_job()
+    assert len(murdock.queue) == 1
+
+
+def test_build_scripts_are_part_of_the_key(github, monkeypatch, tmp_path):
+    monkeypatch.setitem(config.config, "scripts_dir", str(tmp_path))
+    (tmp_path / "build.sh").write_text("#!/bin/sh\n")
+    pr = new_pr(13)
+    pr.start_job()
+    build(pr)
+
+    (tmp_path / "build.sh").write_text("#!/bin/sh\nexit 0\n")
+    pr.start_job()
+    assert len(murdock.queue) == 1
+
+
+def test_rebuild_label_skips_the_cache(github):
+    pr = new_pr(14)
+    pr.start_job()
+    build(pr)
+    github.calls.clear()
+    murdock.merge_tree.cache_clear()
+
+    pr.labels.add(config.rebuild_label)
+    pr.start_job()
+    assert len(murdock.queue) == 1
+    # no blocking github request when queueing a forced rebuild
+    assert not tree_lookups(github)
+
+    # the rebuild label doesn't change the key
+    build(pr)
+    assert len(tree_lookups(github)) == 1
+    pr.labels.discard(config.rebuild_label)
+    pr.start_job()
+    assert len(murdock.queue) == 0
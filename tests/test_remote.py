@@ -0,0 +1,118 @@
+import os
+import time
+
+import pytest
+
+pytest.importorskip("pytoml")
+
+from murdock_ci.jobs import Job, JobResult, JobState
+from murdock_ci.remote import RemoteWorkerPool
+from murdock_ci.scheduler import JobQueue
+
+
+@pytest.fixture
+def queue():
+    return JobQueue()
+
+
+@pytest.fixture
+def pool(queue):
+    return RemoteWorkerPool(queue)
+
+
+@pytest.fixture
+def job(tmp_path, queue):
+    post_build = tmp_path / "build.sh"
+    post_build.write_text("#!/bin/sh\ncp output.txt output.html\n")
+    post_build.chmod(0o755)
+
+    job = Job(str(tmp_path / "job"), str(post_build), { "CI_PULL_NR" : "1" }, cpus=8)
+    queue.put(job)
+    job.set_state(JobState.queued)
+    return job
+
+
+def wait_finished(job):
+    deadline = time.time() + 5
+    while job.state != JobState.finished:
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+
+def test_lease(pool, queue, job):
+    lease = pool.lease("agent", 4, 0)
+
+    assert lease.job is job
+    assert job.worker is lease
+    assert job.state == JobState.running
+    assert job.env["CI_JOBS"] == "4"
+    assert lease.describe()["cpus"] == 4
+    assert pool.get(lease.id) is lease
+    assert len(queue) == 0
+    assert pool.lease("agent", 4, 0) is None
+
+
+def test_warm_cache_jobs_are_not_leased(pool, queue, tmp_path):
+    job = Job(str(tmp_path / "warm"), "build.sh", {}, action="warm_cache")
+    queue.put(job)
+
+    assert pool.lease("agent", 4, 0) is None
+    assert len(queue) == 1
+
+
+def test_output_and_result(pool, job):
+    lease = pool.lease("agent", 4, 0)
+    lease.expires = 0
+    pool.output(lease, b"hello\n")
+    assert lease.expires > time.time()
+
+    pool.finish(lease, JobResult.passed)
+    wait_finished(job)
+
+    assert job.result == JobResult.passed
+    assert pool.get(lease.id) is None
+    with open(os.path.join(job.data_dir(), "output.html")) as f:
+        assert f.read() == "hello\n"
+
+
+def test_cancel(pool, job):
+    lease = pool.lease("agent", 4, 0)
+    job.cancel()
+    assert lease.canceled
+
+    # whatever the agent reports, the job has been canceled
+    pool.finish(lease, JobResult.passed)
+    wait_finished(job)
+    assert job.result == JobResult.canceled
+
+
+def test_expired_lease_is_requeued(pool, queue, job):
+    lease = pool.lease("agent", 4, 0)
+
+    pool.expire(time.time())
+    assert pool.get(lease.id) is lease
+
+    pool.expire(lease.expires + 1)
+    assert pool.get(lease.id) is None
+    assert job.state == JobState.queued
+    assert job.worker is None
+    assert pool.lease("other", 4, 0).job is job
+
+
+def test_expired_canceled_lease_finishes_job(pool, queue, job):
+    lease = pool.lease("agent", 4, 0)
+    job.cancel()
+
+    pool.expire(lease.expires + 1)
+    assert job.state == JobState.finished
+    assert job.result == JobResult.canceled
+    assert len(queue) == 0
+
+
+def test_release(pool, queue, job):
+    lease = pool.lease("agent", 4, 0)
+    pool.release(lease)
+
+    assert pool.get(lease.id) is None
+    assert job.state == JobState.queued
+    assert len(queue) == 1
@@ -0,0 +1,109 @@
+import threading
+
+from murdock_ci.jobs import Job, JobResult, JobState
+from murdock_ci.scheduler import JobQueue, Resources
+
+
+def queued(queue, name, **kwargs):
+    job = Job(name, "build.sh", **kwargs)
+    queue.put(job)
+    job.set_state(JobState.queued)
+    return job
+
+
+def names(queue, fits=None):
+    result = []
+    while True:
+        job = queue.get_nowait(fits)
+        if not job:
+            return result
+        result.append(job.name)
+
+
+def test_priority_then_fifo():
+    queue = JobQueue()
+    queued(queue, "a")
+    queued(queue, "low", priority=-1)
+    queued(queue, "b")
+    queued(queue, "high", priority=1)
+    queued(queue, "c")
+
+    assert names(queue) == [ "high", "a", "b", "c", "low" ]
+
+
+def test_finished_jobs_are_dropped():
+    queue = JobQueue()
+    queued(queue, "a")
+    canceled = queued(queue, "b")
+    queued(queue, "c")
+    canceled.set_state(JobState.finished, JobResult.canceled)
+
+    assert names(queue) == [ "a", "c" ]
+
+
+def test_smaller_job_passes_bigger_one():
+    queue = JobQueue()
+    resources = Resources(4)
+    running = Job("running", "build.sh", cpus=2)
+    assert resources.try_acquire(running)
+
+    queued(queue, "wide", cpus=4)
+    queued(queue, "narrow", cpus=2)
+
+    assert names(queue, resources.try_acquire) == [ "narrow" ]
+    assert resources.allocation(queue.jobs[0]) is None
+
+    resources.release(running)
+    resources.release(Job("narrow", "build.sh"))
+    assert resources.used_cpus == 2
+
+
+def test_resources_clamp_to_host():
+    resources = Resources(4, 1024)
+    job = Job("huge", "build.sh", cpus=64, memory=65536)
+
+    assert resources.try_acquire(job)
+    assert resources.allocation(job) == (4, 1024)
+    assert not resources.try_acquire(Job("small", "build.sh", cpus=1))
+
+    resources.release(job)
+    assert resources.used_cpus == 0 and resources.used_memory == 0
+
+
+def test_max_skips():
+    queue = JobQueue(max_skips=2)
+    resources = Resources(4)
+    running = Job("running", "build.sh", cpus=3)
+    assert resources.try_acquire(running)
+
+    queued(queue, "wide", cpus=4)
+    for n in range(4):
+        queued(queue, "narrow%s" % n, cpus=1)
+
+    def take():
+        job = queue.get_nowait(resources.try_acquire)
+        if job:
+            resources.release(job)
+            return job.name
+
+    # the wide job can be passed twice, then everything waits for it
+    assert [ take() for n in range(4) ] == [ "narrow0", "narrow1", None, None ]
+
+    resources.release(running)
+    assert take() == "wide"
+    assert take() == "narrow2"
+
+
+def test_close_wakes_up_waiting_workers():
+    queue = JobQueue()
+    results = []
+    worker = threading.Thread(target=lambda: results.append(queue.get()))
+    worker.start()
+
+    queue.close()
+    worker.join(5)
+    assert not worker.is_alive()
+    assert results == [ None ]
+
+    queued(queue, "late")
+    assert queue.get_nowait() is None
@@ -0,0 +1,150 @@
+import io
+import os
+import threading
+import time
+
+import pytest
+
+from murdock_ci.supervisor import BuildDir, Supervisor
+
+
+def wait_for(predicate, timeout=5):
+    deadline = time.time() + timeout
+    while not predicate():
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def supervisor():
+    return Supervisor(sigterm_timeout=0.5)
+
+
+def test_output_and_exit(supervisor):
+    output = io.BytesIO()
+    exited = []
+    build = supervisor.spawn([ "sh", "-c", "echo hello; exit 3" ], output,
+                             on_exit=lambda: exited.append(True))
+
+    assert build.wait(5)
+    assert build.returncode == 3
+    assert not build.killed and not build.timed_out
+    assert output.getvalue() == b"hello\n"
+    assert exited == [ True ]
+
+
+def test_kill_escalates_to_sigkill(supervisor):
+    output = io.BytesIO()
+    exited = []
+    # the whole process group ignores SIGTERM
+    build = supervisor.spawn([ "sh", "-c", "trap '' TERM; echo ready; while true; do sleep 0.1; done" ],
+                             output, on_exit=lambda: exited.append(True))
+    wait_for(lambda: output.getvalue() == b"ready\n")
+
+    start = time.time()
+    build.kill()
+    # a killed build is done right away ...
+    assert build.wait(1)
+    assert build.killed
+    assert not exited
+
+    # ... but only reaped after SIGKILL
+    supervisor.drain()
+    assert time.time() - start >= 0.5
+    assert build.returncode == -9
+    assert exited == [ True ]
+
+
+def test_timeout(supervisor):
+    build = supervisor.spawn([ "sleep", "10" ], io.BytesIO(), timeout=0.3)
+
+    assert build.wait(5)
+    assert build.timed_out
+    supervisor.drain()
+    assert build.returncode == -15
+
+
+def test_output_timeout(supervisor):
+    output = io.BytesIO()
+    build = supervisor.spawn([ "sh", "-c", "for i in 1 2 3; do echo $i; sleep 0.2; done; sleep 10" ],
+                             output, output_timeout=0.5)
+
+    assert build.wait(5)
+    assert build.timed_out
+    # output kept the build alive for its first 0.6s
+    assert time.time() - build.time_started >= 0.9
+    assert output.getvalue() == b"1\n2\n3\n"
+
+
+def test_no_timeout_while_printing(supervisor):
+    build = supervisor.spawn([ "sh", "-c", "for i in 1 2 3 4 5; do echo $i; sleep 0.2; done" ],
+                             io.BytesIO(), output_timeout=0.5)
+
+    assert build.wait(5)
+    assert not build.timed_out
+    assert build.returncode == 0
+
+
+def test_drain_waits_for_all_builds(supervisor):
+    builds = [ supervisor.spawn([ "sleep", "0.3" ], io.BytesIO()) for i in range(3) ]
+
+    supervisor.drain()
+    for build in builds:
+        assert build.done.is_set()
+        assert build.returncode == 0
+
+
+class BrokenOutput(object):
+    def write(s, data):
+        raise OSError(28, "No space left on device")
+
+
+def test_output_error_kills_build(supervisor):
+    exited = []
+    build = supervisor.spawn([ "sh", "-c", "echo hello; sleep 10" ], BrokenOutput(),
+                             on_exit=lambda: exited.append(True))
+
+    assert build.wait(5)
+    assert build.abandoned
+    assert exited == [ True ]
+
+    # the supervisor keeps working for other builds
+    output = io.BytesIO()
+    other = supervisor.spawn([ "sh", "-c", "echo hello" ], output)
+    assert other.wait(5)
+    assert other.returncode == 0
+    assert output.getvalue() == b"hello\n"
+    supervisor.drain()
+
+
+def test_build_dir_is_removed_by_last_user(tmp_path):
+    path = str(tmp_path / "build")
+    build_dir = BuildDir.acquire(path)
+    assert os.path.isdir(path)
+
+    build_dir.release()
+    assert os.path.isdir(path)
+    build_dir.release()
+    assert not os.path.exists(path)
+    assert build_dir.removed.is_set()
+
+
+def test_build_dir_waits_for_previous_build(tmp_path):
+    path = str(tmp_path / "build")
+    previous = BuildDir.acquire(path)
+    with open(os.path.join(path, "stale"), "w"):
+        pass
+    previous.release()
+
+    acquired = []
+    thread = threading.Thread(target=lambda: acquired.append(BuildDir.acquire(path)))
+    thread.start()
+    thread.join(0.2)
+    assert not acquired
+
+    # the previous build's process group is gone
+    previous.release()
+    thread.join(5)
+    assert os.listdir(path) == []
+    acquired[0].release()
+    acquired[0].release()
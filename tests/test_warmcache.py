@@ -0,0 +1,87 @@
+import os
+
+import pytest
+
+from murdock_ci.warmcache import WarmCache
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return WarmCache(str(tmp_path), 1024, 2)
+
+
+def build(cache, commit, branch="master", created=None, data=b"x"):
+    tmpdir = cache.prepare("org/repo", commit)
+    with open(os.path.join(tmpdir, "ccache"), "wb") as f:
+        f.write(data)
+    cache.publish("org/repo", branch, commit)
+    if created is not None:
+        entry = cache.entries["org/repo/%s" % commit]
+        entry["created"] = entry["last_used"] = created
+
+
+def test_publish_and_lookup(cache):
+    build(cache, "c1", created=1)
+    build(cache, "c2", created=2)
+
+    assert cache.lookup("org/repo", "master", "c1") == cache.path("org/repo", "c1")
+    # unknown commits fall back to the latest cache of the branch
+    assert cache.lookup("org/repo", "master", "c3") == cache.path("org/repo", "c2")
+    assert cache.lookup("org/repo", "other", "c3") is None
+    assert os.path.isfile(os.path.join(cache.path("org/repo", "c1"), "ccache"))
+    assert not os.path.exists(cache.path("org/repo", "c1") + ".tmp")
+
+
+def test_prepare_refuses_cached_and_building_commits(cache):
+    assert cache.prepare("org/repo", "c1")
+    assert cache.prepare("org/repo", "c1") is None
+
+    cache.discard("org/repo", "c1")
+    assert not os.path.exists(cache.path("org/repo", "c1") + ".tmp")
+
+    build(cache, "c1")
+    assert cache.prepare("org/repo", "c1") is None
+
+
+def test_evicts_least_recently_used(cache):
+    build(cache, "c1", created=1)
+    build(cache, "c2", created=2)
+    cache.entries["org/repo/c1"]["last_used"] = 3
+    build(cache, "c3", created=4)
+
+    assert sorted(cache.entries) == [ "org/repo/c1", "org/repo/c3" ]
+    assert not os.path.exists(cache.path("org/repo", "c2"))
+
+
+def test_keeps_latest_of_each_branch(tmp_path):
+    cache = WarmCache(str(tmp_path), 0, 10)
+    build(cache, "c1", created=1)
+    build(cache, "c2", created=2)
+    build(cache, "s1", branch="stable", created=3)
+
+    # over the size limit, all but the latest of each branch go
+    assert sorted(cache.entries) == [ "org/repo/c2", "org/repo/s1" ]
+
+
+def test_pinned_generations_are_kept(cache):
+    build(cache, "c1", created=1)
+    path = cache.lookup("org/repo", "master", "c1")
+    cache.entries["org/repo/c1"]["last_used"] = 0
+    build(cache, "c2", created=2)
+    build(cache, "c3", created=3)
+
+    assert "org/repo/c1" in cache.entries
+    assert os.path.isdir(path)
+
+    cache.release(path)
+    build(cache, "c4", created=4)
+    assert "org/repo/c1" not in cache.entries
+    assert not os.path.exists(path)
+
+
+def test_index_is_persistent(tmp_path):
+    cache = WarmCache(str(tmp_path), 1024, 2)
+    build(cache, "c1")
+
+    reloaded = WarmCache(str(tmp_path), 1024, 2)
+    assert reloaded.lookup("org/repo", "master", "c1") == cache.path("org/repo", "c1")